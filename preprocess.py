@@ -96,17 +96,40 @@ def normalize(adata, filter_min_counts=True, size_factors=True, normalize_input=
     else:
         adata.raw = adata
 
+    # dense matrices are normalized in place with numpy, sparse ones keep the scanpy calls
+    sparse = sp.sparse.issparse(adata.X)
+    if not sparse and not np.issubdtype(adata.X.dtype, np.floating):
+        adata.X = adata.X.astype(np.float32)
+
     if size_factors:
-        sc.pp.normalize_per_cell(adata)
+        if sparse:
+            sc.pp.normalize_per_cell(adata)
+        else:
+            # drop cells without counts as normalize_per_cell does, so no size factor is 0,
+            # then scale every cell to the median count by dividing it by its size factor
+            sc.pp.filter_cells(adata, min_counts=1)
+            n_counts = adata.obs.n_counts.values
+            adata.X /= (n_counts / np.median(n_counts))[:, None]
         adata.obs['size_factors'] = adata.obs.n_counts / np.median(adata.obs.n_counts)
     else:
         adata.obs['size_factors'] = 1.0
 
     if logtrans_input:
-        sc.pp.log1p(adata)
+        if sparse:
+            sc.pp.log1p(adata)
+        else:
+            np.log1p(adata.X, out=adata.X)
 
     if normalize_input:
-        sc.pp.scale(adata)
+        if sparse:
+            sc.pp.scale(adata)
+        else:
+            X = adata.X
+            mean = X.mean(axis=0)
+            sd = X.std(axis=0, ddof=1)
+            sd[sd == 0] = 1
+            X -= mean
+            X /= sd
 
     return adata
 
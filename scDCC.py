@@ -1,10 +1,8 @@
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 from torch.nn import Parameter
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import DataLoader, TensorDataset
 from layers import ZINBLoss, MeanAct, DispAct
 import numpy as np
 from sklearn.cluster import KMeans
@@ -12,6 +10,12 @@ import math, os
 from sklearn import metrics
 from utils import cluster_acc
 
+def to_cuda_tensor(x):
+    """Move an array (or tensor) to the GPU as float32, without copying if it is already there."""
+    if torch.is_tensor(x):
+        return x.to(device='cuda', dtype=torch.float32)
+    return torch.from_numpy(np.asarray(x, dtype=np.float32)).cuda()
+
 def buildNetwork(layers, type, activation="relu"):
     net = []
     for i in range(1, len(layers)):
@@ -25,7 +29,7 @@ def buildNetwork(layers, type, activation="relu"):
 
 class scDCC(nn.Module):
     def __init__(self, input_dim, z_dim, n_clusters, encodeLayer=[], decodeLayer=[], 
-                 activation="relu", sigma=1., alpha=1., gamma=1., ml_weight=1., cl_weight=1.):
+                 activation="relu", sigma=1., alpha=1., gamma=1., ml_weight=1., cl_weight=1., bf16=False):
         super(scDCC, self).__init__()
         self.z_dim = z_dim
         self.n_clusters = n_clusters
@@ -44,6 +48,8 @@ class scDCC(nn.Module):
 
         self.mu = Parameter(torch.Tensor(n_clusters, z_dim))
         self.zinb_loss = ZINBLoss().cuda()
+        # bf16 only pays off on GPUs with native bf16 tensor cores (Ampere and later); older GPUs emulate it
+        self.use_bf16 = bf16 and torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
 
     def save_model(self, path):
         torch.save(self.state_dict(), path)
@@ -88,13 +94,17 @@ class scDCC(nn.Module):
         num_batch = int(math.ceil(1.0*X.shape[0]/batch_size))
         for batch_idx in range(num_batch):
             xbatch = X[batch_idx*batch_size : min((batch_idx+1)*batch_size, num)]
-            inputs = Variable(xbatch)
-            z,_, _, _, _ = self.forward(inputs)
-            encoded.append(z.data)
+            z,_, _, _, _ = self.forward(xbatch)
+            encoded.append(z.detach())
 
         encoded = torch.cat(encoded, dim=0)
         return encoded
 
+    def autocast(self, cache_enabled=True):
+        # bf16 autocast for the forward pass when enabled with bf16=True; losses are computed in fp32.
+        # The weight cast cache has to be disabled while capturing a CUDA graph.
+        return torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=self.use_bf16, cache_enabled=cache_enabled)
+
     def cluster_loss(self, p, q):
         def kld(target, pred):
             return torch.mean(torch.sum(target*torch.log(target/(pred+1e-6)), dim=-1))
@@ -113,17 +123,21 @@ class scDCC(nn.Module):
         use_cuda = torch.cuda.is_available()
         if use_cuda:
             self.cuda()
-        dataset = TensorDataset(torch.Tensor(x), torch.Tensor(X_raw), torch.Tensor(size_factor))
-        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+        x = to_cuda_tensor(x)
+        X_raw = to_cuda_tensor(X_raw)
+        size_factor = to_cuda_tensor(size_factor)
+        num = x.shape[0]
         print("Pretraining stage")
         optimizer = optim.Adam(filter(lambda p: p.requires_grad, self.parameters()), lr=lr, amsgrad=True)
         for epoch in range(epochs):
-            for batch_idx, (x_batch, x_raw_batch, sf_batch) in enumerate(dataloader):
-                x_tensor = Variable(x_batch).cuda()
-                x_raw_tensor = Variable(x_raw_batch).cuda()
-                sf_tensor = Variable(sf_batch).cuda()
-                _, _, mean_tensor, disp_tensor, pi_tensor = self.forward(x_tensor)
-                loss = self.zinb_loss(x=x_raw_tensor, mean=mean_tensor, disp=disp_tensor, pi=pi_tensor, scale_factor=sf_tensor)
+            # the whole dataset stays on the GPU, shuffled mini-batches are index lookups
+            for batch_idx, idx in enumerate(torch.randperm(num, device=x.device).split(batch_size)):
+                x_tensor = x[idx]
+                x_raw_tensor = X_raw[idx]
+                sf_tensor = size_factor[idx]
+                with self.autocast():
+                    _, _, mean_tensor, disp_tensor, pi_tensor = self.forward(x_tensor)
+                loss = self.zinb_loss(x=x_raw_tensor, mean=mean_tensor.float(), disp=disp_tensor.float(), pi=pi_tensor.float(), scale_factor=sf_tensor)
                 optimizer.zero_grad()
                 loss.backward()
                 optimizer.step()
@@ -138,21 +152,26 @@ class scDCC(nn.Module):
         torch.save(state, newfilename)
 
     def fit(self, X, X_raw, sf, ml_ind1=np.array([]), ml_ind2=np.array([]), cl_ind1=np.array([]), cl_ind2=np.array([]), 
-            ml_p=1., cl_p=1., y=None, lr=1., batch_size=256, num_epochs=10, update_interval=1, tol=1e-3, save_dir=""):
-        '''X: tensor data'''
+            ml_p=1., cl_p=1., y=None, lr=1., batch_size=256, num_epochs=10, update_interval=1, tol=1e-3, save_dir="",
+            cuda_graph=False):
+        '''X: tensor data
+        cuda_graph: capture the clustering step on full-size batches as a CUDA graph and replay it
+        '''
         use_cuda = torch.cuda.is_available()
         if use_cuda:
             self.cuda()
         print("Clustering stage")
-        X = torch.tensor(X).cuda()
-        X_raw = torch.tensor(X_raw).cuda()
-        sf = torch.tensor(sf).cuda()
-        optimizer = optim.Adadelta(filter(lambda p: p.requires_grad, self.parameters()), lr=lr, rho=.95)
+        X = to_cuda_tensor(X)
+        X_raw = to_cuda_tensor(X_raw)
+        sf = to_cuda_tensor(sf)
+        # a captured optimizer step needs its state on the device
+        optimizer = optim.Adadelta(filter(lambda p: p.requires_grad, self.parameters()), lr=lr, rho=.95,
+                                   **({'capturable': True} if cuda_graph else {}))
 
         print("Initializing cluster centers with kmeans.")
         kmeans = KMeans(self.n_clusters, n_init=20)
         data = self.encodeBatch(X)
-        self.y_pred = kmeans.fit_predict(data.data.cpu().numpy())
+        self.y_pred = kmeans.fit_predict(data.detach().cpu().numpy())
         self.y_pred_last = self.y_pred
         self.mu.data.copy_(torch.Tensor(kmeans.cluster_centers_))
         if y is not None:
@@ -161,6 +180,8 @@ class scDCC(nn.Module):
             ari = np.round(metrics.adjusted_rand_score(y, self.y_pred), 5)
             print('Initializing k-means: ACC= %.4f, NMI= %.4f, ARI= %.4f' % (acc, nmi, ari))
 
+        latent = data
+
         self.train()
         num = X.shape[0]
         num_batch = int(math.ceil(1.0*X.shape[0]/batch_size))
@@ -169,6 +190,25 @@ class scDCC(nn.Module):
         cl_num = cl_ind1.shape[0]
         ml_num = ml_ind1.shape[0]
 
+        def cluster_step(inputs, rawinputs, sfinputs, target, cache_enabled=True):
+            with self.autocast(cache_enabled):
+                z, qbatch, meanbatch, dispbatch, pibatch = self.forward(inputs)
+
+            cluster_loss = self.cluster_loss(target, qbatch.float())
+            recon_loss = self.zinb_loss(rawinputs, meanbatch.float(), dispbatch.float(), pibatch.float(), sfinputs)
+            loss = cluster_loss + recon_loss
+            loss.backward()
+            optimizer.step()
+            return cluster_loss.detach(), recon_loss.detach()
+
+        # every full batch has the same shapes, so its step can be captured once and replayed;
+        # batches are copied into these static buffers, the shorter last batch runs eagerly
+        cuda_graph = cuda_graph and num >= batch_size
+        graph, graph_loss, graph_warmup = None, None, 3
+        if cuda_graph:
+            static_batch = [torch.empty_like(X[:batch_size]), torch.empty_like(X_raw[:batch_size]),
+                            torch.empty_like(sf[:batch_size]), torch.empty(batch_size, self.n_clusters, device=X.device)]
+
         final_acc, final_nmi, final_ari, final_epoch = 0, 0, 0, 0
         update_ml = 1
         update_cl = 1
@@ -178,10 +218,10 @@ class scDCC(nn.Module):
                 # update the targe distribution p
                 latent = self.encodeBatch(X)
                 q = self.soft_assign(latent)
-                p = self.target_distribution(q).data
+                p = self.target_distribution(q).detach()
 
                 # evalute the clustering performance
-                self.y_pred = torch.argmax(q, dim=1).data.cpu().numpy()
+                self.y_pred = torch.argmax(q, dim=1).detach().cpu().numpy()
 
                 if y is not None:
                     final_acc = acc = np.round(cluster_acc(y, self.y_pred), 5)
@@ -219,21 +259,33 @@ class scDCC(nn.Module):
                 xrawbatch = X_raw[batch_idx*batch_size : min((batch_idx+1)*batch_size, num)]
                 sfbatch = sf[batch_idx*batch_size : min((batch_idx+1)*batch_size, num)]
                 pbatch = p[batch_idx*batch_size : min((batch_idx+1)*batch_size, num)]
-                optimizer.zero_grad()
-                inputs = Variable(xbatch)
-                rawinputs = Variable(xrawbatch)
-                sfinputs = Variable(sfbatch)
-                target = Variable(pbatch)
 
-                z, qbatch, meanbatch, dispbatch, pibatch = self.forward(inputs)
+                if cuda_graph and len(xbatch) == batch_size:
+                    for buf, batch in zip(static_batch, (xbatch, xrawbatch, sfbatch, pbatch)):
+                        buf.copy_(batch)
+                    if graph_warmup > 0:
+                        # warm up on a side stream before capturing
+                        side_stream = torch.cuda.Stream()
+                        side_stream.wait_stream(torch.cuda.current_stream())
+                        with torch.cuda.stream(side_stream):
+                            optimizer.zero_grad()
+                            cluster_loss, recon_loss = cluster_step(*static_batch)
+                        torch.cuda.current_stream().wait_stream(side_stream)
+                        graph_warmup -= 1
+                    else:
+                        if graph is None:
+                            graph = torch.cuda.CUDAGraph()
+                            optimizer.zero_grad(set_to_none=True)
+                            with torch.cuda.graph(graph):
+                                graph_loss = cluster_step(*static_batch, cache_enabled=False)
+                        graph.replay()
+                        cluster_loss, recon_loss = graph_loss
+                else:
+                    optimizer.zero_grad()
+                    cluster_loss, recon_loss = cluster_step(xbatch, xrawbatch, sfbatch, pbatch)
 
-                cluster_loss = self.cluster_loss(target, qbatch)
-                recon_loss = self.zinb_loss(rawinputs, meanbatch, dispbatch, pibatch, sfinputs)
-                loss = cluster_loss + recon_loss
-                loss.backward()
-                optimizer.step()
-                cluster_loss_val += cluster_loss.data * len(inputs)
-                recon_loss_val += recon_loss.data * len(inputs)
+                cluster_loss_val += cluster_loss * len(xbatch)
+                recon_loss_val += recon_loss * len(xbatch)
                 train_loss = cluster_loss_val + recon_loss_val
 
             print("#Epoch %3d: Total: %.4f Clustering Loss: %.4f ZINB Loss: %.4f" % (
@@ -249,17 +301,14 @@ class scDCC(nn.Module):
                     sf2 = sf[ml_ind2[ml_batch_idx*batch_size : min(ml_num, (ml_batch_idx+1)*batch_size)]]
                     pxraw2 = X_raw[ml_ind2[ml_batch_idx*batch_size : min(ml_num, (ml_batch_idx+1)*batch_size)]]
                     optimizer.zero_grad()
-                    inputs1 = Variable(px1)
-                    rawinputs1 = Variable(pxraw1)
-                    sfinput1 = Variable(sf1)
-                    inputs2 = Variable(px2)
-                    rawinputs2 = Variable(pxraw2)
-                    sfinput2 = Variable(sf2)
-                    z1, q1, mean1, disp1, pi1 = self.forward(inputs1)
-                    z2, q2, mean2, disp2, pi2 = self.forward(inputs2)
-                    loss = (ml_p*self.pairwise_loss(q1, q2, "ML")+self.zinb_loss(rawinputs1, mean1, disp1, pi1, sfinput1) + self.zinb_loss(rawinputs2, mean2, disp2, pi2, sfinput2))
+                    with self.autocast():
+                        z1, q1, mean1, disp1, pi1 = self.forward(px1)
+                        z2, q2, mean2, disp2, pi2 = self.forward(px2)
+                    q1, mean1, disp1, pi1 = q1.float(), mean1.float(), disp1.float(), pi1.float()
+                    q2, mean2, disp2, pi2 = q2.float(), mean2.float(), disp2.float(), pi2.float()
+                    loss = (ml_p*self.pairwise_loss(q1, q2, "ML")+self.zinb_loss(pxraw1, mean1, disp1, pi1, sf1) + self.zinb_loss(pxraw2, mean2, disp2, pi2, sf2))
                     # 0.1 for mnist/reuters, 1 for fashion, the parameters are tuned via grid search on validation set
-                    ml_loss += loss.data
+                    ml_loss += loss.detach()
                     loss.backward()
                     optimizer.step()
 
@@ -269,16 +318,17 @@ class scDCC(nn.Module):
                     px1 = X[cl_ind1[cl_batch_idx*batch_size : min(cl_num, (cl_batch_idx+1)*batch_size)]]
                     px2 = X[cl_ind2[cl_batch_idx*batch_size : min(cl_num, (cl_batch_idx+1)*batch_size)]]
                     optimizer.zero_grad()
-                    inputs1 = Variable(px1)
-                    inputs2 = Variable(px2)
-                    z1, q1, _, _, _ = self.forward(inputs1)
-                    z2, q2, _, _, _ = self.forward(inputs2)
-                    loss = cl_p*self.pairwise_loss(q1, q2, "CL")
-                    cl_loss += loss.data
+                    with self.autocast():
+                        z1, q1, _, _, _ = self.forward(px1)
+                        z2, q2, _, _, _ = self.forward(px2)
+                    loss = cl_p*self.pairwise_loss(q1.float(), q2.float(), "CL")
+                    cl_loss += loss.detach()
                     loss.backward()
                     optimizer.step()
 
             if ml_num_batch >0 and cl_num_batch > 0:
                 print("Pairwise Total:", round(float(ml_loss.cuda()), 2) + float(cl_loss.cuda()), "ML loss", float(ml_loss.cuda()), "CL loss:", float(cl_loss.cuda()))
 
-        return self.y_pred, final_acc, final_nmi, final_ari, final_epoch
+        # latent is the embedding of the last target update, which y_pred was assigned from; if
+        # num_epochs runs out before the tolerance is reached it predates the final epochs of training
+        return self.y_pred, final_acc, final_nmi, final_ari, final_epoch, latent
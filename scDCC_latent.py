@@ -128,7 +128,7 @@ if __name__ == "__main__":
     if not os.path.exists(args.save_dir):
             os.makedirs(args.save_dir)
 
-    y_pred, _, _, _, _ = model.fit(X=adata.X, X_raw=adata.raw.X, sf=adata.obs.size_factors, y=y, batch_size=args.batch_size, num_epochs=args.maxiter, 
+    y_pred, _, _, _, _, _ = model.fit(X=adata.X, X_raw=adata.raw.X, sf=adata.obs.size_factors, y=y, batch_size=args.batch_size, num_epochs=args.maxiter, 
                 ml_ind1=ml_ind1, ml_ind2=ml_ind2, cl_ind1=cl_ind1, cl_ind2=cl_ind2,
                 update_interval=args.update_interval, tol=args.tol, save_dir=args.save_dir)
     print('Total time: %d seconds.' % int(time() - t0))
@@ -1,22 +1,22 @@
 from time import time
-import math, os
+import os
+
+# configure PyTorch's CUDA caching allocator; must be set before CUDA is initialized
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:128")
 
 import torch
-import torch.nn as nn
-from torch.autograd import Variable
-from torch.nn import Parameter
-import torch.nn.functional as F
-import torch.optim as optim
-from torch.utils.data import DataLoader, TensorDataset
-
-from scDCC import scDCC
+
+# TF32 tensor-core math for the fp32 matmuls that stay outside autocast
+torch.set_float32_matmul_precision('high')
+
+from scDCC import scDCC, to_cuda_tensor
 import numpy as np
-import collections
 from sklearn import metrics
 import h5py
+import pandas as pd
 import scanpy.api as sc
 from preprocess import read_dataset, normalize
-from utils_xiang import cluster_acc, generate_random_pair_from_embedding_clustering, generate_random_pair_from_one_CD
+from utils_xiang import cluster_acc, generate_random_pair_from_two_CDs
 
 
 
@@ -42,15 +42,21 @@ if __name__ == "__main__":
     parser.add_argument('--latent_z', default='latent_p0_1.txt')
     parser.add_argument('--lc', default=20, type=int)
     parser.add_argument('--hc', default=90, type=int)
+    parser.add_argument('--cuda_graph', action='store_true',
+                        help='replay the clustering step as a CUDA graph')
+    parser.add_argument('--no_bf16', action='store_true',
+                        help='run the forward passes in fp32 instead of bf16 autocast')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print extra diagnostics about the preprocessed data')
 
     args = parser.parse_args()
 
-    data_mat = h5py.File(args.data_file)
-    x = np.array(data_mat['X'])
-    y = np.array(data_mat['Y'])
-    data_mat.close()
+    # load as float32 so the whole preprocessing chain stays in float32
+    with h5py.File(args.data_file, 'r') as data_mat:
+        x = data_mat['X'][...].astype(np.float32, copy=False)
+        y = data_mat['Y'][...].astype(np.int64, copy=False)
 
-    zifa_latent = np.loadtxt("HumanLiver_marker_ZIFA.txt", delimiter=',')
+    zifa_latent = pd.read_csv("HumanLiver_marker_ZIFA.txt", header=None, dtype=np.float32).values
 
     # preprocessing scRNA-seq read counts matrix
     adata = sc.AnnData(x)
@@ -59,7 +65,7 @@ if __name__ == "__main__":
     adata = read_dataset(adata,
                      transpose=False,
                      test_split=False,
-                     copy=True)
+                     copy=False)
 
     adata = normalize(adata,
                       size_factors=True,
@@ -74,12 +80,13 @@ if __name__ == "__main__":
     print(y.shape)
     print(zifa_latent.shape)
 
-    x_sd = adata.X.std(0)
-    x_sd_median = np.median(x_sd)
-    print("median of gene sd: %.5f" % x_sd_median)
+    if args.verbose:
+        x_sd = adata.X.std(axis=0, dtype=np.float32)
+        x_sd_median = np.median(x_sd)
+        print("median of gene sd: %.5f" % x_sd_median)
 
     if args.n_pairwise > 0:
-        ml_ind1, ml_ind2, cl_ind1, cl_ind2 = generate_random_pair_from_two_CDs(zifa_latent, args.n_pairwise, args.n_clusters, LC=args.lc, HC=args.hc)
+        ml_ind1, ml_ind2, cl_ind1, cl_ind2 = generate_random_pair_from_two_CDs(zifa_latent.T, args.n_pairwise, LC=args.lc, HC=args.hc)
         # ml_ind1, ml_ind2, cl_ind1, cl_ind2 = generate_random_pair_from_two_CDs(zifa_latent, args.n_pairwise, args.n_clusters, LC=20, HC=90)
         # ml_ind1, ml_ind2, cl_ind1, cl_ind2 = generate_random_pair_from_embedding_clustering(zifa_latent, args.n_pairwise, args.n_clusters, ML=0.005, CL=0.8)
 
@@ -90,15 +97,21 @@ if __name__ == "__main__":
 
     sd = 2.5
 
+    # upload the data once; pretraining and clustering both index into these GPU tensors
+    X_gpu = to_cuda_tensor(adata.X)
+    X_raw_gpu = to_cuda_tensor(adata.raw.X)
+    sf_gpu = to_cuda_tensor(adata.obs.size_factors)
+
     model = scDCC(input_dim=adata.n_vars, z_dim=32, n_clusters=args.n_clusters, 
-                encodeLayer=[256, 64], decodeLayer=[64, 256], sigma=sd, gamma=args.gamma).cuda()
+                encodeLayer=[256, 64], decodeLayer=[64, 256], sigma=sd, gamma=args.gamma,
+                bf16=not args.no_bf16).cuda()
 
     print(str(model))
 
     t0 = time()
     if args.ae_weights is None:
         # model.pretrain_autoencoder(x=adata.X, raw_counts=adata.raw.X, size_factor=adata.obs.size_factors, 
-        model.pretrain_autoencoder(x=adata.X, X_raw=adata.raw.X, size_factor=adata.obs.size_factors,
+        model.pretrain_autoencoder(x=X_gpu, X_raw=X_raw_gpu, size_factor=sf_gpu,
                                 batch_size=args.batch_size, epochs=args.pretrain_epochs, ae_weights=args.ae_weight_file)
     else:
         if os.path.isfile(args.ae_weights):
@@ -114,9 +127,12 @@ if __name__ == "__main__":
     if not os.path.exists(args.save_dir):
             os.makedirs(args.save_dir)
 
-    y_pred, _, _, _, _ = model.fit(X=adata.X, X_raw=adata.raw.X, sf=adata.obs.size_factors, y=y, batch_size=args.batch_size, num_epochs=args.maxiter, 
+    # return blocks cached during pretraining before the clustering stage allocates its own
+    torch.cuda.empty_cache()
+
+    y_pred, _, _, _, _, latent_z0 = model.fit(X=X_gpu, X_raw=X_raw_gpu, sf=sf_gpu, y=y, batch_size=args.batch_size, num_epochs=args.maxiter, 
                 ml_ind1=ml_ind1, ml_ind2=ml_ind2, cl_ind1=cl_ind1, cl_ind2=cl_ind2,
-                update_interval=args.update_interval, tol=args.tol, save_dir=args.save_dir)
+                update_interval=args.update_interval, tol=args.tol, save_dir=args.save_dir, cuda_graph=args.cuda_graph)
     print('Total time: %d seconds.' % int(time() - t0))
 
     acc = np.round(cluster_acc(y, y_pred), 5)
@@ -124,8 +140,7 @@ if __name__ == "__main__":
     ari = np.round(metrics.adjusted_rand_score(y, y_pred), 5)
     print('Evaluating cells: ACC= %.4f, NMI= %.4f, ARI= %.4f' % (acc, nmi, ari))
 
-    latent_z0 = model.encodeBatch(torch.tensor(adata.X).cuda())
-    latent_z = latent_z0.data.cpu().numpy()
+    latent_z = latent_z0.detach().cpu().numpy()
     np.savetxt(args.latent_z, latent_z, delimiter=",")
     np.savetxt('pred_y_'+args.latent_z, np.array(y_pred), delimiter=",")
     print('Total time: %d seconds.' % int(time() - t0))
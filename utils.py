@@ -9,12 +9,13 @@ import torch.nn as nn
 import torch.nn.init as init
 import torch.utils.data as data
 from scipy.linalg import norm
+from scipy.optimize import linear_sum_assignment
 from sklearn.cluster import KMeans
 from sklearn.metrics.pairwise import euclidean_distances
 
 def cluster_acc(y_true, y_pred):
     """
-    Calculate clustering accuracy. Require scikit-learn installed
+    Calculate clustering accuracy. Require scipy installed
     # Arguments
         y: true labels, numpy.array with shape `(n_samples,)`
         y_pred: predicted labels, numpy.array with shape `(n_samples,)`
@@ -22,15 +23,12 @@ def cluster_acc(y_true, y_pred):
         accuracy, in [0,1]
     """
     y_true = y_true.astype(np.int64)
+    y_pred = y_pred.astype(np.int64)
     assert y_pred.size == y_true.size
-    D = max(y_pred.max(), y_true.max()) + 1
-    w = np.zeros((D, D), dtype=np.int64)
-    for i in range(y_pred.size):
-        w[y_pred[i], y_true[i]] += 1
-    from sklearn.utils.linear_assignment_ import linear_assignment
-    # from scipy.optimize import linear_sum_assignment as linear_assignment
-    ind = linear_assignment(w.max() - w)
-    return sum([w[i, j] for i, j in ind]) * 1.0 / y_pred.size
+    D = int(max(y_pred.max(), y_true.max())) + 1
+    w = np.bincount(y_pred * D + y_true, minlength=D * D).reshape(D, D)
+    row, col = linear_sum_assignment(w.max() - w)
+    return w[row, col].sum() * 1.0 / y_pred.size
 
 
 def generate_random_pair(y, label_cell_indx, num, error_rate=0):
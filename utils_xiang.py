@@ -1,20 +1,11 @@
-import os
-import sys
-import time
 import math
 import numpy as np
-import random
-import torch
-import torch.nn as nn
-import torch.nn.init as init
-import torch.utils.data as data
-from scipy.linalg import norm
+from scipy.optimize import linear_sum_assignment
 from sklearn.cluster import KMeans
-from sklearn.metrics.pairwise import euclidean_distances
 
 def cluster_acc(y_true, y_pred):
     """
-    Calculate clustering accuracy. Require scikit-learn installed
+    Calculate clustering accuracy. Require scipy installed
     # Arguments
         y: true labels, numpy.array with shape `(n_samples,)`
         y_pred: predicted labels, numpy.array with shape `(n_samples,)`
@@ -22,14 +13,21 @@ def cluster_acc(y_true, y_pred):
         accuracy, in [0,1]
     """
     y_true = y_true.astype(np.int64)
+    y_pred = y_pred.astype(np.int64)
     assert y_pred.size == y_true.size
-    D = max(y_pred.max(), y_true.max()) + 1
-    w = np.zeros((D, D), dtype=np.int64)
-    for i in range(y_pred.size):
-        w[y_pred[i], y_true[i]] += 1
-    from sklearn.utils.linear_assignment_ import linear_assignment
-    ind = linear_assignment(w.max() - w)
-    return sum([w[i, j] for i, j in ind]) * 1.0 / y_pred.size
+    D = int(max(y_pred.max(), y_true.max())) + 1
+    w = np.bincount(y_pred * D + y_true, minlength=D * D).reshape(D, D)
+    row, col = linear_sum_assignment(w.max() - w)
+    return w[row, col].sum() * 1.0 / y_pred.size
+
+
+def shuffle_pairs(ind1, ind2, rng):
+    """
+    Shuffle two index arrays together, keeping the pairs (ind1[i], ind2[i]) aligned.
+    """
+    pairs = np.stack([ind1, ind2], axis=1)
+    rng.shuffle(pairs, axis=0)
+    return pairs[:, 0], pairs[:, 1]
 
 
 def generate_random_pair(y, label_cell_indx, num, error_rate=0):
@@ -39,92 +37,131 @@ def generate_random_pair(y, label_cell_indx, num, error_rate=0):
     ml_ind1, ml_ind2 = [], []
     cl_ind1, cl_ind2 = [], []
     y = np.array(y)
+    label_cell_indx = np.asarray(label_cell_indx)
 
-    def check_ind(ind1, ind2, ind_list1, ind_list2):
-        for (l1, l2) in zip(ind_list1, ind_list2):
-            if ind1 == l1 and ind2 == l2:
-                return True
-        return False
+    # accepted pairs packed into one int, (tmp1 << 32) | tmp2, which hashes faster than a tuple
+    seen = set()
 
+    rng = np.random.Generator(np.random.SFC64())
     error_num = 0
     num0 = num
     while num > 0:
-        tmp1 = random.choice(label_cell_indx)
-        tmp2 = random.choice(label_cell_indx)
-        if tmp1 == tmp2:
-            continue
-        if check_ind(tmp1, tmp2, ml_ind1, ml_ind2):
-            continue
-        if y[tmp1] == y[tmp2]:
-            if error_num >= error_rate*num0:
-                ml_ind1.append(tmp1)
-                ml_ind2.append(tmp2)
-            else:
-                cl_ind1.append(tmp1)
-                cl_ind2.append(tmp2)
-                error_num += 1
-        else:
-            if error_num >= error_rate*num0:
-                cl_ind1.append(tmp1)
-                cl_ind2.append(tmp2)
+        # draw this round's candidates in one call; tolist() gives Python ints, so the packed key cannot overflow
+        for tmp1, tmp2 in rng.choice(label_cell_indx, size=(num, 2)).tolist():
+            if num <= 0:
+                break
+            if tmp1 == tmp2:
+                continue
+            key = (tmp1 << 32) | tmp2
+            if key in seen:
+                continue
+            if y[tmp1] == y[tmp2]:
+                if error_num >= error_rate*num0:
+                    ml_ind1.append(tmp1)
+                    ml_ind2.append(tmp2)
+                else:
+                    cl_ind1.append(tmp1)
+                    cl_ind2.append(tmp2)
+                    error_num += 1
             else:
-                ml_ind1.append(tmp1)
-                ml_ind2.append(tmp2) 
-                error_num += 1               
-        num -= 1
+                if error_num >= error_rate*num0:
+                    cl_ind1.append(tmp1)
+                    cl_ind2.append(tmp2)
+                else:
+                    ml_ind1.append(tmp1)
+                    ml_ind2.append(tmp2)
+                    error_num += 1
+            seen.add(key)
+            num -= 1
     ml_ind1, ml_ind2, cl_ind1, cl_ind2 = np.array(ml_ind1), np.array(ml_ind2), np.array(cl_ind1), np.array(cl_ind2)
-    ml_index = np.random.permutation(ml_ind1.shape[0])
-    cl_index = np.random.permutation(cl_ind1.shape[0])
-    ml_ind1 = ml_ind1[ml_index]
-    ml_ind2 = ml_ind2[ml_index]
-    cl_ind1 = cl_ind1[cl_index]
-    cl_ind2 = cl_ind2[cl_index]
+    ml_ind1, ml_ind2 = shuffle_pairs(ml_ind1, ml_ind2, rng)
+    cl_ind1, cl_ind2 = shuffle_pairs(cl_ind1, cl_ind2, rng)
     return ml_ind1, ml_ind2, cl_ind1, cl_ind2, error_num
 
 
+def sample_pairs(n, classify, num, rng, num_ml=None, num_cl=None, max_draws=None, batch_size=65536):
+    """
+    Batched rejection sampling of pairwise constraints.
+    Candidates are drawn from the numpy Generator `rng`.
+    classify(ind1, ind2) maps two index arrays to boolean must-link and cannot-link masks;
+    must-link wins where both are set. Distinct pairs are accepted in draw order until `num`
+    pairs are found (num_ml / num_cl optionally cap each type) or `max_draws` pairs were drawn.
+    The number of draws used is returned last, counted up to the draw of the final accepted pair.
+    Deduplication and the budgets are resolved per batch with numpy, so no Python loop runs
+    over individual pairs.
+    """
+    ml_pairs, cl_pairs = [np.empty((0, 2), dtype=np.int64)], [np.empty((0, 2), dtype=np.int64)]
+    # accepted pairs packed as ind1 * n + ind2
+    seen = np.empty(0, dtype=np.int64)
+
+    k = 0
+    while num > 0 and (max_draws is None or k < max_draws):
+        size = batch_size if max_draws is None else min(batch_size, max_draws - k)
+        pairs = rng.integers(0, n, size=(size, 2), dtype=np.int64)
+        ind1, ind2 = pairs[:, 0], pairs[:, 1]
+        # position of each candidate within the batch
+        draw = np.arange(size)
+        cand = ind1 != ind2
+        ind1, ind2, draw = ind1[cand], ind2[cand], draw[cand]
+        is_ml, is_cl = classify(ind1, ind2)
+        cand = is_ml | is_cl
+        ind1, ind2, is_ml, draw = ind1[cand], ind2[cand], is_ml[cand], draw[cand]
+
+        # first draw of every pair in this batch that was not accepted before, in draw order
+        key = ind1 * n + ind2
+        _, first = np.unique(key, return_index=True)
+        first.sort()
+        first = first[~np.isin(key[first], seen)]
+        ind1, ind2, is_ml, key, draw = ind1[first], ind2[first], is_ml[first], key[first], draw[first]
+
+        keep = np.ones(key.shape[0], dtype=bool)
+        if num_ml is not None:
+            keep &= ~is_ml | (np.cumsum(is_ml) <= num_ml)
+        if num_cl is not None:
+            keep &= is_ml | (np.cumsum(~is_ml) <= num_cl)
+        keep = np.flatnonzero(keep)[:int(num)]
+        ind1, ind2, is_ml, key, draw = ind1[keep], ind2[keep], is_ml[keep], key[keep], draw[keep]
+
+        ml_pairs.append(np.stack([ind1[is_ml], ind2[is_ml]], axis=1))
+        cl_pairs.append(np.stack([ind1[~is_ml], ind2[~is_ml]], axis=1))
+        seen = np.concatenate([seen, key])
+        if num_ml is not None:
+            num_ml -= int(is_ml.sum())
+        if num_cl is not None:
+            num_cl -= int((~is_ml).sum())
+        num -= key.shape[0]
+        # the batch that fills the quota only used the draws up to its last accepted pair
+        k += size if num > 0 else int(draw[-1]) + 1
+    ml_pairs, cl_pairs = np.concatenate(ml_pairs), np.concatenate(cl_pairs)
+    ml_ind1, ml_ind2, cl_ind1, cl_ind2 = ml_pairs[:, 0], ml_pairs[:, 1], cl_pairs[:, 0], cl_pairs[:, 1]
+    return ml_ind1, ml_ind2, cl_ind1, cl_ind2, k
+
+
+def pairwise_distance_quantile(latent_embedding, q, rng, n_samples=200000):
+    """
+    Estimate quantiles of the pairwise euclidean distances between cells from
+    `n_samples` random pairs instead of the full N x N distance matrix.
+    Zero distances (self pairs, duplicated cells) are excluded as before.
+    """
+    ind1, ind2 = rng.integers(0, latent_embedding.shape[0], size=(2, n_samples))
+    dist = np.linalg.norm(latent_embedding[ind1] - latent_embedding[ind2], axis=1)
+    return np.quantile(dist[dist>0], q)
+
+
 def generate_random_pair_from_proteins(latent_embedding, num, ML=0.1, CL=0.9):
     """
     Generate random pairwise constraints.
     """
-    ml_ind1, ml_ind2 = [], []
-    cl_ind1, cl_ind2 = [], []
-
-    def check_ind(ind1, ind2, ind_list1, ind_list2):
-        for (l1, l2) in zip(ind_list1, ind_list2):
-            if ind1 == l1 and ind2 == l2:
-                return True
-        return False
+    rng = np.random.Generator(np.random.SFC64())
+    cutoff_ML, cutoff_CL = pairwise_distance_quantile(latent_embedding, [ML, CL], rng)
 
-    latent_dist = euclidean_distances(latent_embedding, latent_embedding)
-    latent_dist_tril = np.tril(latent_dist, -1)
-    latent_dist_vec = latent_dist_tril.flatten()
-    latent_dist_vec = latent_dist_vec[latent_dist_vec>0]
-    cutoff_ML = np.quantile(latent_dist_vec, ML)
-    cutoff_CL = np.quantile(latent_dist_vec, CL)
+    def classify(ind1, ind2):
+        dist = np.linalg.norm(latent_embedding[ind1] - latent_embedding[ind2], axis=1)
+        return dist < cutoff_ML, dist > cutoff_CL
 
-    while num > 0:
-        tmp1 = random.randint(0, latent_embedding.shape[0] - 1)
-        tmp2 = random.randint(0, latent_embedding.shape[0] - 1)
-        if tmp1 == tmp2:
-            continue
-        if check_ind(tmp1, tmp2, ml_ind1, ml_ind2):
-            continue
-        if norm(latent_embedding[tmp1] - latent_embedding[tmp2], 2) < cutoff_ML:
-            ml_ind1.append(tmp1)
-            ml_ind2.append(tmp2)
-        elif norm(latent_embedding[tmp1] - latent_embedding[tmp2], 2) > cutoff_CL:
-            cl_ind1.append(tmp1)
-            cl_ind2.append(tmp2)
-        else:
-            continue
-        num -= 1
-    ml_ind1, ml_ind2, cl_ind1, cl_ind2 = np.array(ml_ind1), np.array(ml_ind2), np.array(cl_ind1), np.array(cl_ind2)
-    ml_index = np.random.permutation(ml_ind1.shape[0])
-    cl_index = np.random.permutation(cl_ind1.shape[0])
-    ml_ind1 = ml_ind1[ml_index]
-    ml_ind2 = ml_ind2[ml_index]
-    cl_ind1 = cl_ind1[cl_index]
-    cl_ind2 = cl_ind2[cl_index]
+    ml_ind1, ml_ind2, cl_ind1, cl_ind2, _ = sample_pairs(latent_embedding.shape[0], classify, num, rng)
+    ml_ind1, ml_ind2 = shuffle_pairs(ml_ind1, ml_ind2, rng)
+    cl_ind1, cl_ind2 = shuffle_pairs(cl_ind1, cl_ind2, rng)
     return ml_ind1, ml_ind2, cl_ind1, cl_ind2
 
 # What is LC and HC?
@@ -132,50 +169,24 @@ def generate_random_pair_from_two_CDs(latent_embedding, num, LC=20, HC=90):
     """
     Generate random pairwise constraints.
     """
-    ml_ind1, ml_ind2 = [], []
-    cl_ind1, cl_ind2 = [], []
-
-    def check_ind(ind1, ind2, ind_list1, ind_list2):
-        for (l1, l2) in zip(ind_list1, ind_list2):
-            if ind1 == l1 and ind2 == l2:
-                return True
-        return False
-
-    lc1= np.percentile(latent_embedding[0,:], LC)
-    lc2= np.percentile(latent_embedding[1,:], LC)
-    mc1 = np.percentile(latent_embedding[0,:], HC)
-    mc2 = np.percentile(latent_embedding[1,:], HC)
-    k=0
-    while num > 0 and k < 20000**2:
-        k = k+1
-        tmp1 = random.randint(0, latent_embedding.shape[1] - 1)
-        tmp2 = random.randint(0, latent_embedding.shape[1] - 1)
-        if tmp1 == tmp2:
-            continue
-        if check_ind(tmp1, tmp2, ml_ind1, ml_ind2):
-            continue
-        if np.logical_and(np.logical_and(latent_embedding[0,tmp1] > mc1,latent_embedding[0,tmp2] > mc1), np.logical_and(latent_embedding[1,tmp1] <= lc2, latent_embedding[1,tmp2] <= lc2)):
-            ml_ind1.append(tmp1)
-            ml_ind2.append(tmp2)
-        elif np.logical_and(np.logical_and(latent_embedding[0,tmp1] <= lc1,latent_embedding[0,tmp2] <= lc1), np.logical_and(latent_embedding[1,tmp1] > mc2, latent_embedding[1,tmp2] > mc2)):
-            ml_ind1.append(tmp1)
-            ml_ind2.append(tmp2)
-        elif np.logical_and(np.logical_and(latent_embedding[0,tmp1] > mc1, latent_embedding[1,tmp1] <= lc2), np.logical_and(latent_embedding[0,tmp2] <= lc1, latent_embedding[1,tmp2] > mc2)):
-            cl_ind1.append(tmp1)
-            cl_ind2.append(tmp2)
-        elif np.logical_and(np.logical_and(latent_embedding[0,tmp1] <= lc1,latent_embedding[1,tmp1] > mc2), np.logical_and(latent_embedding[0,tmp2] > mc1, latent_embedding[1,tmp2] <= lc2)):
-            cl_ind1.append(tmp1)
-            cl_ind2.append(tmp2)
-        else:
-            continue
-        num -= 1
-    ml_ind1, ml_ind2, cl_ind1, cl_ind2 = np.array(ml_ind1), np.array(ml_ind2), np.array(cl_ind1), np.array(cl_ind2)
-    ml_index = np.random.permutation(ml_ind1.shape[0])
-    cl_index = np.random.permutation(cl_ind1.shape[0])
-    ml_ind1 = ml_ind1[ml_index]
-    ml_ind2 = ml_ind2[ml_index]
-    cl_ind1 = cl_ind1[cl_index]
-    cl_ind2 = cl_ind2[cl_index]
+    rng = np.random.Generator(np.random.SFC64())
+    e0 = np.ascontiguousarray(latent_embedding[0])
+    e1 = np.ascontiguousarray(latent_embedding[1])
+    lc1, mc1 = np.percentile(e0, [LC, HC])
+    lc2, mc2 = np.percentile(e1, [LC, HC])
+
+    # cells high in the first gene and low in the second, and the other way round
+    type_a = np.logical_and(e0 > mc1, e1 <= lc2)
+    type_b = np.logical_and(e0 <= lc1, e1 > mc2)
+
+    def classify(ind1, ind2):
+        is_ml = (type_a[ind1] & type_a[ind2]) | (type_b[ind1] & type_b[ind2])
+        is_cl = (type_a[ind1] & type_b[ind2]) | (type_b[ind1] & type_a[ind2])
+        return is_ml, is_cl
+
+    ml_ind1, ml_ind2, cl_ind1, cl_ind2, k = sample_pairs(e0.shape[0], classify, num, rng, max_draws=20000**2)
+    ml_ind1, ml_ind2 = shuffle_pairs(ml_ind1, ml_ind2, rng)
+    cl_ind1, cl_ind2 = shuffle_pairs(cl_ind1, cl_ind2, rng)
     print(np.shape(ml_ind1))
     print(np.shape(cl_ind1))
     print(k)
@@ -185,49 +196,25 @@ def generate_random_pair_from_one_CD(latent_embedding, num, LC=20, HC=90, gene=0
     """
     Generate random pairwise constraints.
     """
-    ml_ind1, ml_ind2 = [], []
-    cl_ind1, cl_ind2 = [], []
-
-    def check_ind(ind1, ind2, ind_list1, ind_list2):
-        for (l1, l2) in zip(ind_list1, ind_list2):
-            if ind1 == l1 and ind2 == l2:
-                return True
-        return False
-
-    lc1= np.percentile(latent_embedding[gene,:], LC)
-    mc1 = np.percentile(latent_embedding[gene,:], HC)
-    k=0
-    num1 = num/2
-    num2 = num/2
-    while (num1 > 0 or num2 > 0) and k < 1000000:
-        k = k+1
-        tmp1 = random.randint(0, latent_embedding.shape[1] - 1)
-        tmp2 = random.randint(0, latent_embedding.shape[1] - 1)
-        if tmp1 == tmp2:
-            continue
-        if check_ind(tmp1, tmp2, ml_ind1, ml_ind2):
-            continue
-        if np.logical_and(latent_embedding[gene,tmp1] > mc1,latent_embedding[gene,tmp2] > mc1) and num1>0:
-            ml_ind1.append(tmp1)
-            ml_ind2.append(tmp2)
-            num1 -= 1
-        elif np.logical_and(latent_embedding[gene,tmp1] > mc1,latent_embedding[gene,tmp2] <= lc1) and num2>0:
-            cl_ind1.append(tmp1)
-            cl_ind2.append(tmp2)
-            num2 -= 1
-        elif np.logical_and(latent_embedding[gene,tmp1] <= lc1,latent_embedding[gene,tmp2] > mc1) and num2>0:
-            cl_ind1.append(tmp1)
-            cl_ind2.append(tmp2)
-            num2 -= 1
-        else:
-            continue
-    ml_ind1, ml_ind2, cl_ind1, cl_ind2 = np.array(ml_ind1), np.array(ml_ind2), np.array(cl_ind1), np.array(cl_ind2)
-    ml_index = np.random.permutation(ml_ind1.shape[0])
-    cl_index = np.random.permutation(cl_ind1.shape[0])
-    ml_ind1 = ml_ind1[ml_index]
-    ml_ind2 = ml_ind2[ml_index]
-    cl_ind1 = cl_ind1[cl_index]
-    cl_ind2 = cl_ind2[cl_index]
+    rng = np.random.Generator(np.random.SFC64())
+    e0 = np.ascontiguousarray(latent_embedding[gene])
+    lc1, mc1 = np.percentile(e0, [LC, HC])
+
+    high = e0 > mc1
+    low = e0 <= lc1
+
+    def classify(ind1, ind2):
+        is_ml = high[ind1] & high[ind2]
+        is_cl = (high[ind1] & low[ind2]) | (low[ind1] & high[ind2])
+        return is_ml, is_cl
+
+    # half of the constraints are must-links, the other half cannot-links
+    num1 = int(math.ceil(num/2))
+    num2 = int(math.ceil(num/2))
+    ml_ind1, ml_ind2, cl_ind1, cl_ind2, k = sample_pairs(e0.shape[0], classify, num1 + num2, rng,
+                                                         num_ml=num1, num_cl=num2, max_draws=1000000)
+    ml_ind1, ml_ind2 = shuffle_pairs(ml_ind1, ml_ind2, rng)
+    cl_ind1, cl_ind2 = shuffle_pairs(cl_ind1, cl_ind2, rng)
     print(np.shape(ml_ind1))
     print(np.shape(cl_ind1))
     print(k)
@@ -237,67 +224,36 @@ def generate_random_pair_from_CD_markers(markers, num, low1=0.4, high1=0.6, low2
     """
     Generate random pairwise constraints.
     """
-    ml_ind1, ml_ind2 = [], []
-    cl_ind1, cl_ind2 = [], []
-
-    def check_ind(ind1, ind2, ind_list1, ind_list2):
-        for (l1, l2) in zip(ind_list1, ind_list2):
-            if ind1 == l1 and ind2 == l2:
-                return True
-        return False
-
-    gene_low1 = np.quantile(markers[0], low1)
-    gene_high1 = np.quantile(markers[0], high1)
-    gene_low2 = np.quantile(markers[1], low1)
-    gene_high2 = np.quantile(markers[1], high1)
-
-    gene_low1_ml = np.quantile(markers[0], low2)
-    gene_high1_ml = np.quantile(markers[0], high2)
-    gene_low2_ml = np.quantile(markers[1], low2)
-    gene_high2_ml = np.quantile(markers[1], high2)
-    gene_low3 = np.quantile(markers[2], low2)
-    gene_high3 = np.quantile(markers[2], high2)
-    gene_low4 = np.quantile(markers[3], low2)
-    gene_high4 = np.quantile(markers[3], high2)
-
-    while num > 0:
-        tmp1 = random.randint(0, markers.shape[1] - 1)
-        tmp2 = random.randint(0, markers.shape[1] - 1)
-        if tmp1 == tmp2:
-            continue
-        if check_ind(tmp1, tmp2, ml_ind1, ml_ind2):
-            continue
-        if markers[0, tmp1] < gene_low1 and markers[1, tmp1] > gene_high2 and markers[0, tmp2] > gene_high1 and markers[1, tmp2] < gene_low2:
-            cl_ind1.append(tmp1)
-            cl_ind2.append(tmp2)
-        elif markers[0, tmp2] < gene_low1 and markers[1, tmp2] > gene_high2 and markers[0, tmp1] > gene_high1 and markers[1, tmp1] < gene_low2:
-            cl_ind1.append(tmp1)
-            cl_ind2.append(tmp2)
-        elif markers[1, tmp1] > gene_high2_ml and markers[2, tmp1] > gene_high3 and markers[1, tmp2] > gene_high2_ml and markers[2, tmp2] > gene_high3:
-            ml_ind1.append(tmp1)
-            ml_ind2.append(tmp2)
-        elif markers[1, tmp1] > gene_high2_ml and markers[2, tmp1] < gene_low3 and markers[1, tmp2] > gene_high2_ml and markers[2, tmp2] < gene_low3:
-            ml_ind1.append(tmp1)
-            ml_ind2.append(tmp2)
-        elif markers[0, tmp1] > gene_high1_ml and markers[2, tmp1] > gene_high3 and markers[1, tmp2] > gene_high1_ml and markers[2, tmp2] > gene_high3:
-            ml_ind1.append(tmp1)
-            ml_ind2.append(tmp2)
-        elif markers[0, tmp1] > gene_high1_ml and markers[2, tmp1] < gene_low3 and markers[3, tmp1] > gene_high4 and markers[1, tmp2] > gene_high1_ml and markers[2, tmp2] < gene_low3 and markers[3, tmp2] > gene_high4:
-            ml_ind1.append(tmp1)
-            ml_ind2.append(tmp2)
-        elif markers[0, tmp1] > gene_high1_ml and markers[2, tmp1] < gene_low3 and markers[3, tmp1] < gene_low4 and markers[1, tmp2] > gene_high1_ml and markers[2, tmp2] < gene_low3 and markers[3, tmp2] < gene_low4:
-            ml_ind1.append(tmp1)
-            ml_ind2.append(tmp2)
-        else:
-            continue
-        num -= 1
-    ml_ind1, ml_ind2, cl_ind1, cl_ind2 = np.array(ml_ind1), np.array(ml_ind2), np.array(cl_ind1), np.array(cl_ind2)
-    ml_index = np.random.permutation(ml_ind1.shape[0])
-    cl_index = np.random.permutation(cl_ind1.shape[0])
-    ml_ind1 = ml_ind1[ml_index]
-    ml_ind2 = ml_ind2[ml_index]
-    cl_ind1 = cl_ind1[cl_index]
-    cl_ind2 = cl_ind2[cl_index]
+    rng = np.random.Generator(np.random.SFC64())
+    g0, g1, g2, g3 = [np.ascontiguousarray(markers[i]) for i in range(4)]
+    # one sort per marker; rows are the probabilities, columns the four markers
+    cutoffs = np.quantile(np.stack([g0, g1, g2, g3]), [low1, high1, low2, high2], axis=1)
+    gene_low1, gene_low2 = cutoffs[0, :2]
+    gene_high1, gene_high2 = cutoffs[1, :2]
+    gene_low1_ml, gene_low2_ml, gene_low3, gene_low4 = cutoffs[2]
+    gene_high1_ml, gene_high2_ml, gene_high3, gene_high4 = cutoffs[3]
+
+    # every rule is a condition on the first cell and a condition on the second cell,
+    # so evaluate both once per cell and only look them up per candidate pair
+    cl_a = (g0 < gene_low1) & (g1 > gene_high2)
+    cl_b = (g0 > gene_high1) & (g1 < gene_low2)
+    ml_rules = [((g1 > gene_high2_ml) & (g2 > gene_high3), (g1 > gene_high2_ml) & (g2 > gene_high3)),
+                ((g1 > gene_high2_ml) & (g2 < gene_low3), (g1 > gene_high2_ml) & (g2 < gene_low3)),
+                ((g0 > gene_high1_ml) & (g2 > gene_high3), (g1 > gene_high1_ml) & (g2 > gene_high3)),
+                ((g0 > gene_high1_ml) & (g2 < gene_low3) & (g3 > gene_high4), (g1 > gene_high1_ml) & (g2 < gene_low3) & (g3 > gene_high4)),
+                ((g0 > gene_high1_ml) & (g2 < gene_low3) & (g3 < gene_low4), (g1 > gene_high1_ml) & (g2 < gene_low3) & (g3 < gene_low4))]
+
+    def classify(ind1, ind2):
+        is_cl = (cl_a[ind1] & cl_b[ind2]) | (cl_a[ind2] & cl_b[ind1])
+        is_ml = np.zeros(ind1.shape[0], dtype=bool)
+        for first, second in ml_rules:
+            is_ml |= first[ind1] & second[ind2]
+        # the cannot-link rules are checked first
+        return is_ml & ~is_cl, is_cl
+
+    ml_ind1, ml_ind2, cl_ind1, cl_ind2, _ = sample_pairs(g0.shape[0], classify, num, rng)
+    ml_ind1, ml_ind2 = shuffle_pairs(ml_ind1, ml_ind2, rng)
+    cl_ind1, cl_ind2 = shuffle_pairs(cl_ind1, cl_ind2, rng)
     return ml_ind1, ml_ind2, cl_ind1, cl_ind2
 
 
@@ -305,49 +261,20 @@ def generate_random_pair_from_embedding_clustering(latent_embedding, num, n_clus
     """
     Generate random pairwise constraints.
     """
-    ml_ind1, ml_ind2 = [], []
-    cl_ind1, cl_ind2 = [], []
-
-    def check_ind(ind1, ind2, ind_list1, ind_list2):
-        for (l1, l2) in zip(ind_list1, ind_list2):
-            if ind1 == l1 and ind2 == l2:
-                return True
-        return False
-
+    rng = np.random.Generator(np.random.SFC64())
     kmeans = KMeans(n_clusters=n_clusters, n_init=20)
     y_pred = kmeans.fit(latent_embedding).labels_
 
-    latent_dist = euclidean_distances(latent_embedding, latent_embedding)
-    latent_dist_tril = np.tril(latent_dist, -1)
-    latent_dist_vec = latent_dist_tril.flatten()
-    latent_dist_vec = latent_dist_vec[latent_dist_vec>0]
-    cutoff_ML = np.quantile(latent_dist_vec, ML)
-    cutoff_CL = np.quantile(latent_dist_vec, CL)
+    cutoff_CL = pairwise_distance_quantile(latent_embedding, CL, rng)
 
+    def classify(ind1, ind2):
+        is_ml = y_pred[ind1] == y_pred[ind2]
+        dist = np.linalg.norm(latent_embedding[ind1] - latent_embedding[ind2], axis=1)
+        return is_ml, ~is_ml & (dist > cutoff_CL)
 
-    while num > 0:
-        tmp1 = random.randint(0, latent_embedding.shape[0] - 1)
-        tmp2 = random.randint(0, latent_embedding.shape[0] - 1)
-        if tmp1 == tmp2:
-            continue
-        if check_ind(tmp1, tmp2, ml_ind1, ml_ind2):
-            continue
-        if y_pred[tmp1]==y_pred[tmp2]:
-            ml_ind1.append(tmp1)
-            ml_ind2.append(tmp2)
-        elif y_pred[tmp1]!=y_pred[tmp2] and norm(latent_embedding[tmp1] - latent_embedding[tmp2], 2) > cutoff_CL:
-            cl_ind1.append(tmp1)
-            cl_ind2.append(tmp2)
-        else:
-            continue
-        num -= 1
-    ml_ind1, ml_ind2, cl_ind1, cl_ind2 = np.array(ml_ind1), np.array(ml_ind2), np.array(cl_ind1), np.array(cl_ind2)
-    ml_index = np.random.permutation(ml_ind1.shape[0])
-    cl_index = np.random.permutation(cl_ind1.shape[0])
-    ml_ind1 = ml_ind1[ml_index]
-    ml_ind2 = ml_ind2[ml_index]
-    cl_ind1 = cl_ind1[cl_index]
-    cl_ind2 = cl_ind2[cl_index]
+    ml_ind1, ml_ind2, cl_ind1, cl_ind2, _ = sample_pairs(latent_embedding.shape[0], classify, num, rng)
+    ml_ind1, ml_ind2 = shuffle_pairs(ml_ind1, ml_ind2, rng)
+    cl_ind1, cl_ind2 = shuffle_pairs(cl_ind1, cl_ind2, rng)
     return ml_ind1, ml_ind2, cl_ind1, cl_ind2
 
 def generate_random_pair_from_onemarker(gene_vector, num, ML=0.9, CL=0.1):
@@ -365,11 +292,7 @@ def generate_random_pair_from_onemarker(gene_vector, num, ML=0.9, CL=0.1):
     ml_ind1, ml_ind2 = [], []
     cl_ind1, cl_ind2 = [], []
 
-    def check_ind(ind1, ind2, ind_list1, ind_list2):
-        for (l1, l2) in zip(ind_list1, ind_list2):
-                if ind1 == l1 and ind2 == l2:
-                    return True
-        return False
+    seen = set()
 
     cutoff_ML = np.quantile(gene_vector, ML)
     cutoff_CL = np.quantile(gene_vector, CL)
@@ -379,7 +302,7 @@ def generate_random_pair_from_onemarker(gene_vector, num, ML=0.9, CL=0.1):
         tmp2 = random.randint(0, gene_vector.shape[0] - 1)
         if tmp1 == tmp2:
             continue
-        if check_ind(tmp1, tmp2, ml_ind1, ml_ind2):
+        if (tmp1, tmp2) in seen:
             continue
         if gene_vector[tmp1] > cutoff_ML and gene_vector[tmp2] > cutoff_ML:
             ml_ind1.append(tmp1)
@@ -392,6 +315,7 @@ def generate_random_pair_from_onemarker(gene_vector, num, ML=0.9, CL=0.1):
             cl_ind2.append(tmp2)
         else:
             continue
+        seen.add((tmp1, tmp2))
         num -= 1
     ml_ind1, ml_ind2, cl_ind1, cl_ind2 = np.array(ml_ind1), np.array(ml_ind2), np.array(cl_ind1), np.array(cl_ind2)
     ml_index = np.random.permutation(ml_ind1.shape[0])